@@ -1,14 +1,17 @@
 #!/usr/bin/env python3
 import json
+import logging
 import sys
+from concurrent.futures import ThreadPoolExecutor
 import singer
 import singer.utils as singer_utils
 from singer import metadata, metrics
 import tap_salesforce.salesforce
 from tap_salesforce.sync import (
     sync_stream, resume_syncing_bulk_query, get_stream_version)
-from tap_salesforce.salesforce import Salesforce
+from tap_salesforce.salesforce import Salesforce, BULK_API_TYPE
 from tap_salesforce.salesforce.bulk import Bulk
+from tap_salesforce.salesforce.describe_cache import cached_describe
 from tap_salesforce.salesforce.exceptions import (
     TapSalesforceException, TapSalesforceQuotaExceededException, TapSalesforceBulkAPIDisabledException)
 
@@ -29,28 +32,42 @@ CONFIG = {
     'start_date': None
 }
 
-FORCED_FULL_TABLE = {
+FORCED_FULL_TABLE = frozenset({
     'BackgroundOperationResult'  # Does not support ordering by CreatedDate
-}
+})
+
+# Replication key candidates, in order of preference
+REPLICATION_KEY_CANDIDATES = ('SystemModstamp', 'LastModifiedDate', 'CreatedDate')
 
 
 def get_replication_key(sobject_name, fields):
     if sobject_name in FORCED_FULL_TABLE:
         return None
 
-    fields_list = [f['name'] for f in fields]
+    field_names = {f['name'] for f in fields}
 
-    if 'SystemModstamp' in fields_list:
-        return 'SystemModstamp'
-    elif 'LastModifiedDate' in fields_list:
-        return 'LastModifiedDate'
-    elif 'CreatedDate' in fields_list:
-        return 'CreatedDate'
-    elif 'LoginTime' in fields_list and sobject_name == 'LoginHistory':
+    for replication_key in REPLICATION_KEY_CANDIDATES:
+        if replication_key in field_names:
+            return replication_key
+
+    if 'LoginTime' in field_names and sobject_name == 'LoginHistory':
         return 'LoginTime'
     return None
 
 
+def get_stream_metadata(replication_key, key_properties):
+    stream_mdata = {}
+    if replication_key:
+        stream_mdata['valid-replication-keys'] = [replication_key]
+    else:
+        stream_mdata['forced-replication-method'] = {
+            'replication-method': 'FULL_TABLE',
+            'reason': 'No replication keys found from the Salesforce API'}
+
+    stream_mdata['table-key-properties'] = key_properties
+    return stream_mdata
+
+
 def stream_is_selected(mdata):
     return mdata.get((), {}).get('selected', False)
 
@@ -102,39 +119,48 @@ def build_state(raw_state, catalog):
 # pylint: disable=undefined-variable
 
 
-def create_property_schema(field, mdata, source_type):
+def create_property_schema(field, source_type):
     field_name = field['name']
 
     if field_name == "Id":
-        mdata = metadata.write(
-            mdata, ('properties', field_name), 'inclusion', 'automatic')
+        field_mdata = {'inclusion': 'automatic'}
     else:
-        mdata = metadata.write(
-            mdata, ('properties', field_name), 'inclusion', 'available')
+        field_mdata = {'inclusion': 'available'}
 
-    property_schema, mdata = salesforce.field_to_property_schema(
-        field, mdata, source_type)
+    property_schema = salesforce.field_to_property_schema(
+        field, field_mdata, source_type)
 
-    return (property_schema, mdata)
+    return (property_schema, field_mdata)
 
 
-def create_report_property_schema(field, mdata, source_type):
-    field_name = field['label']
+def create_report_property_schema(field, source_type):
+    field_mdata = {'inclusion': 'available'}
 
-    mdata = metadata.write(
-        mdata, ('properties', field_name), 'inclusion', 'available')
+    property_schema = salesforce.field_to_property_schema(
+        field, field_mdata, source_type)
 
-    property_schema, mdata = salesforce.field_to_property_schema(
-        field, mdata, source_type)
+    return (property_schema, field_mdata)
 
-    return (property_schema, mdata)
+
+def write_catalog(catalog):
+    # json.dumps without indent uses the C encoder in one shot, whereas
+    # json.dump(indent=4) streams many small chunks from the Python encoder
+    sys.stdout.write(json.dumps(catalog, separators=(',', ':')))
 
 
 # pylint: disable=too-many-branches,too-many-statements
-def do_discover(sf):
+def do_discover(sf, minimal_discover=False):
     if sf.source_type == 'object':
-        do_discover_object(sf)
+        if minimal_discover:
+            do_discover_object_minimal(sf)
+        else:
+            do_discover_object(sf)
     elif sf.source_type == 'report':
+        if minimal_discover:
+            # The report's stream name is only known from its describe, so
+            # there is nothing to save by deferring field discovery
+            LOGGER.info(
+                "minimal_discover is not supported for reports, discovering all fields")
         do_discover_report(sf)
 
 
@@ -153,16 +179,25 @@ def do_discover_report(sf):
 
     unsupported_fields = set()
     properties = {}
-    mdata = metadata.new()
+    # Compiled metadata keyed by breadcrumb, built with plain dict operations
+    # and converted with metadata.to_list once the stream is complete
+    mdata = {}
+
+    source_type = sf.source_type
+    is_bulk = sf.api_type == BULK_API_TYPE
 
     # Loop over the report's fields
     for field_name, field in fields.items():
-        property_schema, mdata = create_report_property_schema(
-            field, mdata, sf.source_type)
+        breadcrumb = ('properties', field_name)
+
+        property_schema, field_mdata = create_report_property_schema(
+            field, source_type)
+        # The field's inclusion metadata is keyed by its label
+        mdata[('properties', field['label'])] = field_mdata
 
         # Compound Address fields and geolocations cannot be queried by the Bulk API, so we ignore them
-        if field['dataType'] in ("address", "location") and sf.api_type == tap_salesforce.salesforce.BULK_API_TYPE:
-            mdata.pop(('properties', field_name), None)
+        if is_bulk and field['dataType'] in ("address", "location"):
+            mdata.pop(breadcrumb, None)
             continue
 
         # we haven't been able to observe any records with a json field, so we
@@ -171,29 +206,30 @@ def do_discover_report(sf):
             unsupported_fields.add(
                 (field_name, 'do not currently support json fields - please contact support'))
 
-        inclusion = metadata.get(
-            mdata, ('properties', field_name), 'inclusion')
+        inclusion = mdata.get(breadcrumb, {}).get('inclusion')
 
         if sf.select_fields_by_default and inclusion != 'unsupported':
-            mdata = metadata.write(
-                mdata, ('properties', field_name), 'selected-by-default', True)
+            mdata.setdefault(breadcrumb, {})['selected-by-default'] = True
 
         properties[field_name] = property_schema
 
     # There are cases where compound fields are referenced by the associated
     # subfields but are not actually present in the field list
-    field_name_set = {f for f in fields}
-    filtered_unsupported_fields = [
-        f for f in unsupported_fields if f[0] in field_name_set]
-    missing_unsupported_field_names = [
-        f[0] for f in unsupported_fields if f[0] not in field_name_set]
+    # fields is keyed by field name, so it is tested for membership directly
+    filtered_unsupported_fields = []
+    missing_unsupported_field_names = []
+    for f in unsupported_fields:
+        if f[0] in fields:
+            filtered_unsupported_fields.append(f)
+        else:
+            missing_unsupported_field_names.append(f[0])
 
-    if missing_unsupported_field_names:
+    if missing_unsupported_field_names and LOGGER.isEnabledFor(logging.INFO):
         LOGGER.info("Ignoring the following unsupported fields for report %s as they are missing from the field list: %s",
                     sf.report_id,
                     ', '.join(sorted(missing_unsupported_field_names)))
 
-    if filtered_unsupported_fields:
+    if filtered_unsupported_fields and LOGGER.isEnabledFor(logging.INFO):
         LOGGER.info("Not syncing the following unsupported fields for report %s: %s",
                     sf.report_id,
                     ', '.join(sorted([k for k, _ in filtered_unsupported_fields])))
@@ -201,20 +237,14 @@ def do_discover_report(sf):
     # Any property added to unsupported_fields has metadata generated and
     # removed
     for prop, description in filtered_unsupported_fields:
-        if metadata.get(mdata, ('properties', prop),
-                        'selected-by-default'):
-            metadata.delete(
-                mdata, ('properties', prop), 'selected-by-default')
-
-        mdata = metadata.write(
-            mdata, ('properties', prop), 'unsupported-description', description)
-        mdata = metadata.write(
-            mdata, ('properties', prop), 'inclusion', 'unsupported')
+        prop_mdata = mdata.setdefault(('properties', prop), {})
+        prop_mdata.pop('selected-by-default', None)
+        prop_mdata['unsupported-description'] = description
+        prop_mdata['inclusion'] = 'unsupported'
 
     # this is the last entry with empty breadcumb which is required othwerise stream won't be picked up
     # table-key-properties is also required
-    mdata = metadata.write(
-        mdata, (), 'table-key-properties', [])
+    mdata[()] = {'table-key-properties': []}
 
     schema = {
         'type': 'object',
@@ -245,11 +275,53 @@ def do_discover_report(sf):
                    not in unsupported_tag_objects]
 
     result = {'streams': entries}
-    json.dump(result, sys.stdout, indent=4)
+    write_catalog(result)
+
+
+def check_object_is_supported(sf):
+    sobject_name = sf.object_name
+
+    # Skip blacklisted SF objects depending on the api_type in use
+    # ChangeEvent objects are not queryable via Bulk or REST (undocumented)
+    if sobject_name in sf.get_blacklisted_objects() or sobject_name.endswith("ChangeEvent"):
+        LOGGER.error("Getting requested object is not supported")
+        raise Exception("Getting requested object is not supported")
+
+
+def do_discover_object_minimal(sf):
+    """Generates a catalog entry for the object without building its field
+    schemas. The entry is marked with needs-field-discovery so do_sync
+    expands it, and has the same stream level metadata as full discovery."""
+    check_object_is_supported(sf)
+
+    # The field names are only needed to pick the replication key
+    fields = cached_describe(sf)['fields']
+    stream_mdata = get_stream_metadata(
+        get_replication_key(sf.object_name, fields), ['Id'])
+    stream_mdata['needs-field-discovery'] = True
+
+    entry = {
+        'stream': sf.object_name,
+        'tap_stream_id': sf.object_name,
+        'schema': {
+            'type': 'object',
+            'additionalProperties': False,
+            'properties': {}
+        },
+        'metadata': [{
+            'breadcrumb': [],
+            'metadata': stream_mdata}]
+    }
+
+    write_catalog({'streams': [entry]})
 
 
 def do_discover_object(sf):
     """Describes a Salesforce instance's objects and generates a JSON schema for each field."""
+    write_catalog({'streams': discover_object_entries(sf)})
+
+
+def discover_object_entries(sf, use_cache=True):
     key_properties = ['Id']
 
     sf_custom_setting_objects = []
@@ -258,20 +330,24 @@ def do_discover_object(sf):
     # For each SF Object describe it, loop its fields and build a schema
     entries = []
 
-    # Check if the user has BULK API enabled
-    if sf.api_type == 'BULK' and not Bulk(sf).has_permissions():
-        raise TapSalesforceBulkAPIDisabledException(
-            'This client does not have Bulk API permissions, received "API_DISABLED_FOR_ORG" error code')
-
     sobject_name = sf.object_name
 
-    # Skip blacklisted SF objects depending on the api_type in use
-    # ChangeEvent objects are not queryable via Bulk or REST (undocumented)
-    if sobject_name in sf.get_blacklisted_objects() or sobject_name.endswith("ChangeEvent"):
-        LOGGER.error("Getting requested object is not supported")
-        raise Exception("Getting requested object is not supported")
+    check_object_is_supported(sf)
 
-    sobject_description = sf.describe()
+    # The describe does not depend on the Bulk API permission check, so run
+    # it in the background to overlap the two round-trips
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        if use_cache:
+            describe_future = executor.submit(cached_describe, sf)
+        else:
+            describe_future = executor.submit(sf.describe)
+
+        # Check if the user has BULK API enabled
+        if sf.api_type == 'BULK' and not Bulk(sf).has_permissions():
+            raise TapSalesforceBulkAPIDisabledException(
+                'This client does not have Bulk API permissions, received "API_DISABLED_FOR_ORG" error code')
+
+        sobject_description = describe_future.result()
 
     # Cache customSetting and Tag objects to check for blacklisting after
     # all objects have been described
@@ -292,64 +368,70 @@ def do_discover_object(sf):
 
     unsupported_fields = set()
     properties = {}
-    mdata = metadata.new()
+    # Compiled metadata keyed by breadcrumb, built with plain dict operations
+    # and converted with metadata.to_list once the stream is complete
+    mdata = {}
 
     found_id_field = False
+    field_name_set = set()
+
+    # Blacklisted fields are dependent on the api_type being used
+    blacklisted_fields = sf.get_blacklisted_fields()
+    source_type = sf.source_type
+    is_bulk = sf.api_type == BULK_API_TYPE
 
     # Loop over the object's fields
     for f in fields:
         field_name = f['name']
+        field_name_set.add(field_name)
 
         if field_name == "Id":
             found_id_field = True
 
-        property_schema, mdata = create_property_schema(
-            f, mdata, sf.source_type)
+        property_schema, field_mdata = create_property_schema(
+            f, source_type)
 
         # Compound Address fields and geolocations cannot be queried by the Bulk API, so we ignore them
-        if f['type'] in ("address", "location") and sf.api_type == tap_salesforce.salesforce.BULK_API_TYPE:
-            mdata.pop(('properties', field_name), None)
+        if is_bulk and f['type'] in ("address", "location"):
             continue
 
+        mdata[('properties', field_name)] = field_mdata
+
         # we haven't been able to observe any records with a json field, so we
         # are marking it as unavailable until we have an example to work with
         if f['type'] == "json":
             unsupported_fields.add(
                 (field_name, 'do not currently support json fields - please contact support'))
 
-        # Blacklisted fields are dependent on the api_type being used
-        field_pair = (sobject_name, field_name)
-        if field_pair in sf.get_blacklisted_fields():
-            unsupported_fields.add(
-                (field_name, sf.get_blacklisted_fields()[field_pair]))
-
-        inclusion = metadata.get(
-            mdata, ('properties', field_name), 'inclusion')
+        blacklist_reason = blacklisted_fields.get((sobject_name, field_name))
+        if blacklist_reason:
+            unsupported_fields.add((field_name, blacklist_reason))
 
-        if sf.select_fields_by_default and inclusion != 'unsupported':
-            mdata = metadata.write(
-                mdata, ('properties', field_name), 'selected-by-default', True)
+        if sf.select_fields_by_default and field_mdata['inclusion'] != 'unsupported':
+            field_mdata['selected-by-default'] = True
 
         properties[field_name] = property_schema
 
     if replication_key:
-        mdata = metadata.write(
-            mdata, ('properties', replication_key), 'inclusion', 'automatic')
+        mdata.setdefault(('properties', replication_key), {})[
+            'inclusion'] = 'automatic'
 
     # There are cases where compound fields are referenced by the associated
     # subfields but are not actually present in the field list
-    field_name_set = {f['name'] for f in fields}
-    filtered_unsupported_fields = [
-        f for f in unsupported_fields if f[0] in field_name_set]
-    missing_unsupported_field_names = [
-        f[0] for f in unsupported_fields if f[0] not in field_name_set]
+    filtered_unsupported_fields = []
+    missing_unsupported_field_names = []
+    for f in unsupported_fields:
+        if f[0] in field_name_set:
+            filtered_unsupported_fields.append(f)
+        else:
+            missing_unsupported_field_names.append(f[0])
 
-    if missing_unsupported_field_names:
+    if missing_unsupported_field_names and LOGGER.isEnabledFor(logging.INFO):
         LOGGER.info("Ignoring the following unsupported fields for object %s as they are missing from the field list: %s",
                     sobject_name,
                     ', '.join(sorted(missing_unsupported_field_names)))
 
-    if filtered_unsupported_fields:
+    if filtered_unsupported_fields and LOGGER.isEnabledFor(logging.INFO):
         LOGGER.info("Not syncing the following unsupported fields for object %s: %s",
                     sobject_name,
                     ', '.join(sorted([k for k, _ in filtered_unsupported_fields])))
@@ -365,30 +447,12 @@ def do_discover_object(sf):
     # Any property added to unsupported_fields has metadata generated and
     # removed
     for prop, description in filtered_unsupported_fields:
-        if metadata.get(mdata, ('properties', prop),
-                        'selected-by-default'):
-            metadata.delete(
-                mdata, ('properties', prop), 'selected-by-default')
-
-        mdata = metadata.write(
-            mdata, ('properties', prop), 'unsupported-description', description)
-        mdata = metadata.write(
-            mdata, ('properties', prop), 'inclusion', 'unsupported')
-
-    if replication_key:
-        mdata = metadata.write(
-            mdata, (), 'valid-replication-keys', [replication_key])
-    else:
-        mdata = metadata.write(
-            mdata,
-            (),
-            'forced-replication-method',
-            {
-                'replication-method': 'FULL_TABLE',
-                'reason': 'No replication keys found from the Salesforce API'})
+        prop_mdata = mdata.setdefault(('properties', prop), {})
+        prop_mdata.pop('selected-by-default', None)
+        prop_mdata['unsupported-description'] = description
+        prop_mdata['inclusion'] = 'unsupported'
 
-    mdata = metadata.write(
-        mdata, (), 'table-key-properties', key_properties)
+    mdata[()] = get_stream_metadata(replication_key, key_properties)
 
     schema = {
         'type': 'object',
@@ -417,8 +481,28 @@ def do_discover_object(sf):
         entries = [e for e in entries if e['stream']
                    not in unsupported_tag_objects]
 
-    result = {'streams': entries}
-    json.dump(result, sys.stdout, indent=4)
+    return entries
+
+
+def expand_catalog_entry(sf, catalog_entry):
+    """Fills in the schema and field metadata of a catalog entry produced by
+    minimal discovery. Stream level metadata set on the entry is kept."""
+    LOGGER.info("%s: Discovering fields", catalog_entry['tap_stream_id'])
+
+    # The stream is about to be synced, so describe it fresh rather than
+    # selecting fields from a cached schema
+    entries = discover_object_entries(sf, use_cache=False)
+    if not entries:
+        raise TapSalesforceException(
+            "Unable to discover fields for {}".format(catalog_entry['tap_stream_id']))
+
+    mdata = metadata.to_map(entries[0]['metadata'])
+    stream_mdata = metadata.to_map(catalog_entry['metadata']).get((), {})
+    mdata.setdefault((), {}).update(
+        {k: v for k, v in stream_mdata.items() if k != 'needs-field-discovery'})
+
+    catalog_entry['schema'] = entries[0]['schema']
+    catalog_entry['metadata'] = metadata.to_list(mdata)
 
 
 def do_sync(sf, catalog, state):
@@ -430,17 +514,16 @@ def do_sync(sf, catalog, state):
         LOGGER.info("Starting sync")
 
     for catalog_entry in catalog["streams"]:
-        stream_version = get_stream_version(catalog_entry, state)
+        # Cached on sf, so the sync functions reuse this map
+        mdata = sf.get_metadata_map(catalog_entry)
+        stream_version = get_stream_version(catalog_entry, state, mdata)
         stream = catalog_entry['stream']
         stream_alias = catalog_entry.get('stream_alias')
         stream_name = catalog_entry["tap_stream_id"]
         activate_version_message = singer.ActivateVersionMessage(
             stream=(stream_alias or stream), version=stream_version)
 
-        catalog_metadata = metadata.to_map(catalog_entry['metadata'])
-        replication_key = catalog_metadata.get((), {}).get('replication-key')
-
-        mdata = metadata.to_map(catalog_entry['metadata'])
+        replication_key = mdata.get((), {}).get('replication-key')
 
         if not stream_is_selected(mdata):
             LOGGER.info("%s: Skipping - not selected", stream_name)
@@ -456,10 +539,13 @@ def do_sync(sf, catalog, state):
         else:
             LOGGER.info("%s: Starting", stream_name)
 
+        if mdata.get((), {}).get('needs-field-discovery'):
+            expand_catalog_entry(sf, catalog_entry)
+            mdata = sf.get_metadata_map(catalog_entry)
+
         state["current_stream"] = stream_name
         singer.write_state(state)
-        key_properties = metadata.to_map(catalog_entry['metadata']).get(
-            (), {}).get('table-key-properties')
+        key_properties = mdata.get((), {}).get('table-key-properties')
         singer.write_schema(
             stream,
             catalog_entry['schema'],
@@ -467,8 +553,7 @@ def do_sync(sf, catalog, state):
             replication_key,
             stream_alias)
 
-        job_id = singer.get_bookmark(
-            state, catalog_entry['tap_stream_id'], 'JobID')
+        job_id = singer.get_bookmark(state, stream_name, 'JobID')
         if job_id:
             with metrics.record_counter(stream) as counter:
                 LOGGER.info(
@@ -483,30 +568,28 @@ def do_sync(sf, catalog, state):
                 # 2. The job partially completed, in which case make JobHighestBookmarkSeen the new bookmark, or
                 #    existing bookmark if no bookmark exists for the Job.
                 # 3. The job completely failed, in which case maintain the existing bookmark, or None if no bookmark
-                state.get('bookmarks', {}).get(
-                    catalog_entry['tap_stream_id'], {}).pop('JobID', None)
-                state.get('bookmarks', {}).get(
-                    catalog_entry['tap_stream_id'], {}).pop('BatchIDs', None)
-                bookmark = state.get('bookmarks', {}).get(catalog_entry['tap_stream_id'], {}) \
-                                                     .pop('JobHighestBookmarkSeen', None)
-                existing_bookmark = state.get('bookmarks', {}).get(catalog_entry['tap_stream_id'], {}) \
-                                                              .pop(replication_key, None)
+                stream_bookmarks = state.setdefault(
+                    'bookmarks', {}).setdefault(stream_name, {})
+                stream_bookmarks.pop('JobID', None)
+                stream_bookmarks.pop('BatchIDs', None)
+                bookmark = stream_bookmarks.pop('JobHighestBookmarkSeen', None)
+                existing_bookmark = stream_bookmarks.pop(replication_key, None)
                 state = singer.write_bookmark(
                     state,
-                    catalog_entry['tap_stream_id'],
+                    stream_name,
                     replication_key,
                     bookmark or existing_bookmark)  # If job is removed, reset to existing bookmark or None
                 singer.write_state(state)
         else:
             # Tables with a replication_key or an empty bookmark will emit an
             # activate_version at the beginning of their sync
-            bookmark_is_empty = state.get('bookmarks', {}).get(
-                catalog_entry['tap_stream_id']) is None
+            bookmark_is_empty = state.get(
+                'bookmarks', {}).get(stream_name) is None
 
             if replication_key or bookmark_is_empty:
                 singer.write_message(activate_version_message)
                 state = singer.write_bookmark(state,
-                                              catalog_entry['tap_stream_id'],
+                                              stream_name,
                                               'version',
                                               stream_version)
             counter = sync_stream(sf, catalog_entry, state)
@@ -541,21 +624,22 @@ def main_impl():
         sf.login()
 
         if args.discover:
-            do_discover(sf)
+            minimal_discover = CONFIG.get('minimal_discover')
+            do_discover(sf, minimal_discover is True or (isinstance(
+                minimal_discover, str) and minimal_discover.lower() == 'true'))
         elif args.properties:
             catalog = args.properties
 
             # Sort the properties
             streams = catalog['streams']
             for stream in streams:
-                new_properties = {}
                 old_properties = stream['schema']['properties']
                 order = stream['column_order']
 
-                for column in order:
-                    new_properties[column] = old_properties[column]
-
-                stream['schema']['properties'] = new_properties
+                # Catalogs produced by discovery are already in column order
+                if list(old_properties) != order:
+                    stream['schema']['properties'] = {
+                        column: old_properties[column] for column in order}
 
             state = build_state(args.state, catalog)
             do_sync(sf, catalog, state)
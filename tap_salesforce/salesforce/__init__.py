@@ -1,5 +1,5 @@
+import logging
 import re
-import threading
 import time
 import backoff
 import requests
@@ -19,11 +19,16 @@ LOGGER = singer.get_logger()
 
 # The minimum expiration setting for SF Refresh Tokens is 15 minutes
 REFRESH_TOKEN_EXPIRATION_PERIOD = 900
+# Log in again this many seconds before the token is due to be refreshed
+REFRESH_TOKEN_MARGIN = 60
+
+# Request body keys that are never written to the logs
+REDACTED_BODY_KEYS = frozenset(['client_secret', 'refresh_token'])
 
 BULK_API_TYPE = "BULK"
 REST_API_TYPE = "REST"
 
-STRING_TYPES = set([
+STRING_TYPES = frozenset([
     'id',
     'string',
     'picklist',
@@ -40,23 +45,23 @@ STRING_TYPES = set([
     'datacategorygroupreference'
 ])
 
-NUMBER_TYPES = set([
+NUMBER_TYPES = frozenset([
     'double',
     'currency',
     'percent'
 ])
 
-DATE_TYPES = set([
+DATE_TYPES = frozenset([
     'datetime',
     'date'
 ])
 
-BINARY_TYPES = set([
+BINARY_TYPES = frozenset([
     'base64',
     'byte'
 ])
 
-LOOSE_TYPES = set([
+LOOSE_TYPES = frozenset([
     'anyType',
 
     # A calculated field's type can be any of the supported
@@ -64,9 +69,12 @@ LOOSE_TYPES = set([
     'calculated'
 ])
 
+# Types whose schemas already allow null, or shouldn't be wrapped in one
+NO_NULL_WRAP_TYPES = DATE_TYPES | frozenset(['location'])
+
 
 # The following objects are not supported by the bulk API.
-UNSUPPORTED_BULK_API_SALESFORCE_OBJECTS = set(['AssetTokenEvent',
+UNSUPPORTED_BULK_API_SALESFORCE_OBJECTS = frozenset(['AssetTokenEvent',
                                                'AttachedContentNote',
                                                'EventWhoRelation',
                                                'QuoteTemplateRichTextData',
@@ -83,7 +91,7 @@ UNSUPPORTED_BULK_API_SALESFORCE_OBJECTS = set(['AssetTokenEvent',
                                                'UndecidedEventRelation'])
 
 # The following objects have certain WHERE clause restrictions so we exclude them.
-QUERY_RESTRICTED_SALESFORCE_OBJECTS = set(['Announcement',
+QUERY_RESTRICTED_SALESFORCE_OBJECTS = frozenset(['Announcement',
                                            'ContentDocumentLink',
                                            'CollaborationGroupRecord',
                                            'Vote',
@@ -105,7 +113,7 @@ QUERY_RESTRICTED_SALESFORCE_OBJECTS = set(['Announcement',
                                            'FlexQueueItem'])
 
 # The following objects are not supported by the query method being used.
-QUERY_INCOMPATIBLE_SALESFORCE_OBJECTS = set(['ListViewChartInstance',
+QUERY_INCOMPATIBLE_SALESFORCE_OBJECTS = frozenset(['ListViewChartInstance',
                                              'FeedLike',
                                              'OutgoingEmail',
                                              'OutgoingEmailRelation',
@@ -129,12 +137,33 @@ QUERY_INCOMPATIBLE_SALESFORCE_OBJECTS = set(['ListViewChartInstance',
                                              'QuoteTemplateRichTextData'])
 
 
+# Salesforce types whose JSON schema is a single scalar type
+SCALAR_SCHEMA_TYPES = dict.fromkeys(STRING_TYPES, "string")
+SCALAR_SCHEMA_TYPES.update(dict.fromkeys(NUMBER_TYPES, "number"))
+SCALAR_SCHEMA_TYPES.update({
+    'boolean': "boolean",
+    'int': "integer",
+    'time': "string",
+    'json': "string"
+})
+
+# Matches the Sforce-Limit-Info header, e.g. "api-usage=25/15000"
+API_USAGE_PATTERN = re.compile(r'api-usage=(\d+)/(\d+)$')
+
+BULK_API_BLACKLISTED_OBJECTS = UNSUPPORTED_BULK_API_SALESFORCE_OBJECTS | \
+    QUERY_RESTRICTED_SALESFORCE_OBJECTS | QUERY_INCOMPATIBLE_SALESFORCE_OBJECTS
+REST_API_BLACKLISTED_OBJECTS = QUERY_RESTRICTED_SALESFORCE_OBJECTS | \
+    QUERY_INCOMPATIBLE_SALESFORCE_OBJECTS
+
+
 def log_backoff_attempt(details):
     LOGGER.info(
         "ConnectionError detected, triggering backoff: %d try", details.get("tries"))
 
 
-def field_to_property_schema(field, mdata, source_type):  # pylint:disable=too-many-branches
+def field_to_property_schema(field, field_mdata, source_type):  # pylint:disable=too-many-branches
+    """Returns the JSON schema for a field, recording any inclusion changes
+    directly on the field's metadata dict."""
     property_schema = {}
 
     if source_type == 'report':
@@ -144,16 +173,17 @@ def field_to_property_schema(field, mdata, source_type):  # pylint:disable=too-m
         field_name = field['name']
         sf_type = field['type']
 
-    if sf_type in STRING_TYPES:
-        property_schema['type'] = "string"
-    elif sf_type in DATE_TYPES:
+    schema_type = SCALAR_SCHEMA_TYPES.get(sf_type)
+    if schema_type is not None:
+        # The nillable field cannot be trusted
+        if field_name != 'Id':
+            return {'type': ["null", schema_type]}
+        return {'type': schema_type}
+
+    if sf_type in DATE_TYPES:
         date_type = {"type": "string", "format": "date-time"}
         string_type = {"type": ["string", "null"]}
         property_schema["anyOf"] = [date_type, string_type]
-    elif sf_type == "boolean":
-        property_schema['type'] = "boolean"
-    elif sf_type in NUMBER_TYPES:
-        property_schema['type'] = "number"
     elif sf_type == "address":
         property_schema['type'] = "object"
         property_schema['properties'] = {
@@ -166,18 +196,12 @@ def field_to_property_schema(field, mdata, source_type):  # pylint:disable=too-m
             "latitude": {"type": ["null", "number"]},
             "geocodeAccuracy": {"type": ["null", "string"]}
         }
-    elif sf_type == "int":
-        property_schema['type'] = "integer"
-    elif sf_type == "time":
-        property_schema['type'] = "string"
     elif sf_type in LOOSE_TYPES:
-        return property_schema, mdata  # No type = all types
+        return property_schema  # No type = all types
     elif sf_type in BINARY_TYPES:
-        mdata = metadata.write(
-            mdata, ('properties', field_name), "inclusion", "unsupported")
-        mdata = metadata.write(mdata, ('properties', field_name),
-                               "unsupported-description", "binary data")
-        return property_schema, mdata
+        field_mdata["inclusion"] = "unsupported"
+        field_mdata["unsupported-description"] = "binary data"
+        return property_schema
     elif sf_type == 'location':
         # geo coordinates are numbers or objects divided into two fields for lat/long
         property_schema['type'] = ["number", "object", "null"]
@@ -185,17 +209,15 @@ def field_to_property_schema(field, mdata, source_type):  # pylint:disable=too-m
             "longitude": {"type": ["null", "number"]},
             "latitude": {"type": ["null", "number"]}
         }
-    elif sf_type == 'json':
-        property_schema['type'] = "string"
     else:
         raise TapSalesforceException(
             "Found unsupported type: {}".format(sf_type))
 
     # The nillable field cannot be trusted
-    if field_name != 'Id' and sf_type != 'location' and sf_type not in DATE_TYPES:
+    if field_name != 'Id' and sf_type not in NO_NULL_WRAP_TYPES:
         property_schema['type'] = ["null", property_schema['type']]
 
-    return property_schema, mdata
+    return property_schema
 
 
 class Salesforce():
@@ -222,6 +244,7 @@ class Salesforce():
         self.session = requests.Session()
         self.access_token = None
         self.instance_url = None
+        self.user_id = None
         if isinstance(quota_percent_per_run, str) and quota_percent_per_run.strip() == '':
             quota_percent_per_run = None
         if isinstance(quota_percent_total, str) and quota_percent_total.strip() == '':
@@ -237,9 +260,13 @@ class Salesforce():
         self.default_start_date = default_start_date
         self.rest_requests_attempted = 0
         self.jobs_completed = 0
+        # Kept for callers that cancel it; relogin now happens in _make_request
         self.login_timer = None
+        self._token_deadline = None
         self.data_url = "{}/services/data/v41.0/{}"
+        self._api_base = None
         self.pk_chunking = False
+        self._metadata_maps = {}
 
         self.source_type = source_type if source_type else None
         self.object_name = object_name if object_name else None
@@ -271,10 +298,13 @@ class Salesforce():
         return {"Authorization": "Bearer {}".format(self.access_token),
                 "Content-Type": "application/json"}
 
-    # pylint: disable=anomalous-backslash-in-string,line-too-long
+    # pylint: disable=line-too-long
     def check_rest_quota_usage(self, headers):
-        match = re.search('^api-usage=(\d+)/(\d+)$',
-                          headers.get('Sforce-Limit-Info'))
+        limit_info = headers.get('Sforce-Limit-Info')
+        if not limit_info:
+            return
+
+        match = API_USAGE_PATTERN.match(limit_info)
 
         if match is None:
             return
@@ -305,6 +335,23 @@ class Salesforce():
                                                                        self.quota_percent_per_run)
             raise TapSalesforceQuotaExceededException(partial_message)
 
+    def _url(self, endpoint):
+        return self._api_base + endpoint
+
+    def _refresh_expired_token(self, headers):
+        if self._token_deadline is None or time.monotonic() < self._token_deadline:
+            return
+
+        self.login()
+
+        # Callers build their headers once and reuse them, so swap the new
+        # token into the dict in place.
+        if headers:
+            if 'Authorization' in headers:
+                headers['Authorization'] = "Bearer {}".format(self.access_token)
+            if 'X-SFDC-Session' in headers:
+                headers['X-SFDC-Session'] = self.access_token
+
     # pylint: disable=too-many-arguments
     @backoff.on_exception(backoff.expo,
                           requests.exceptions.ConnectionError,
@@ -312,14 +359,25 @@ class Salesforce():
                           factor=2,
                           on_backoff=log_backoff_attempt)
     def _make_request(self, http_method, url, headers=None, body=None, stream=False, params=None):
+        self._refresh_expired_token(headers)
+
+        log_request = LOGGER.isEnabledFor(logging.INFO)
+
         if http_method == "GET":
-            LOGGER.info("Making %s request to %s with params: %s",
-                        http_method, url, params)
+            if log_request:
+                LOGGER.info("Making %s request to %s with params: %s",
+                            http_method, url, params)
             resp = self.session.get(
                 url, headers=headers, stream=stream, params=params)
         elif http_method == "POST":
-            LOGGER.info("Making %s request to %s with body %s",
-                        http_method, url, body)
+            if log_request:
+                if isinstance(body, dict):
+                    log_body = {k: ('***' if k in REDACTED_BODY_KEYS else v)
+                                for k, v in body.items()}
+                else:
+                    log_body = body
+                LOGGER.info("Making %s request to %s with body %s",
+                            http_method, url, log_body)
             resp = self.session.post(url, headers=headers, data=body)
         else:
             raise TapSalesforceException("Unsupported HTTP method")
@@ -335,6 +393,19 @@ class Salesforce():
 
         return resp
 
+    # pylint: disable=no-self-use
+    def _parse_error_json(self, resp):
+        """Decodes an error response body, returning None when it isn't JSON
+        (Salesforce can answer with large HTML error pages) so callers can
+        raise the original HTTP error instead of a decoding one."""
+        if resp is None or not resp.headers.get('Content-Type', '').startswith('application/json'):
+            return None
+
+        try:
+            return resp.json()
+        except ValueError:
+            return None
+
     def login(self):
         if self.is_sandbox:
             login_url = 'https://test.salesforce.com/services/oauth2/token'
@@ -346,6 +417,9 @@ class Salesforce():
 
         LOGGER.info("Attempting login via OAuth2")
 
+        # Cleared so the login request itself doesn't trigger another login
+        self._token_deadline = None
+
         resp = None
         try:
             resp = self._make_request("POST", login_url, body=login_body, headers={
@@ -357,6 +431,11 @@ class Salesforce():
 
             self.access_token = auth['access_token']
             self.instance_url = auth['instance_url']
+            # The OAuth identity URL, unique per org and user
+            self.user_id = auth.get('id')
+            self._api_base = self.data_url.format(self.instance_url, '')
+            self._token_deadline = time.monotonic() + \
+                REFRESH_TOKEN_EXPIRATION_PERIOD - REFRESH_TOKEN_MARGIN
         except Exception as e:
             error_message = str(e)
             if resp is None and hasattr(e, 'response') and e.response is not None:  # pylint:disable=no-member
@@ -366,11 +445,6 @@ class Salesforce():
                 error_message = error_message + \
                     ", Response from Salesforce: {}".format(resp.text)
             raise Exception(error_message) from e
-        finally:
-            LOGGER.info("Starting new login timer")
-            self.login_timer = threading.Timer(
-                REFRESH_TOKEN_EXPIRATION_PERIOD, self.login)
-            self.login_timer.start()
 
     def describe(self):
         """Describes a specific object or a specific report"""
@@ -379,11 +453,11 @@ class Salesforce():
         if self.source_type == 'object':
             endpoint = f'sobjects/{self.object_name}/describe'
             endpoint_tag = self.object_name
-            url = self.data_url.format(self.instance_url, endpoint)
+            url = self._url(endpoint)
         elif self.source_type == 'report':
             endpoint = f'analytics/reports/{self.report_id}/describe'
             endpoint_tag = self.report_id
-            url = self.data_url.format(self.instance_url, endpoint)
+            url = self._url(endpoint)
 
         with metrics.http_request_timer("describe") as timer:
             timer.tags['endpoint'] = endpoint_tag
@@ -391,19 +465,42 @@ class Salesforce():
 
         return resp.json()
 
-    # pylint: disable=no-self-use
+    def get_metadata_map(self, catalog_entry):
+        """Returns metadata.to_map of the entry's metadata, converting it only
+        once for as long as the entry keeps the same metadata list."""
+        raw_metadata = catalog_entry['metadata']
+        cached = self._metadata_maps.get(catalog_entry['tap_stream_id'])
+
+        if cached is None or cached[0] is not raw_metadata:
+            cached = (raw_metadata, metadata.to_map(raw_metadata))
+            self._metadata_maps[catalog_entry['tap_stream_id']] = cached
+
+        return cached[1]
+
     def _get_selected_properties(self, catalog_entry):
-        mdata = metadata.to_map(catalog_entry['metadata'])
+        mdata = self.get_metadata_map(catalog_entry)
         properties = catalog_entry['schema'].get('properties', {})
 
-        return [k for k in properties.keys()
-                if singer.should_sync_field(metadata.get(mdata, ('properties', k), 'inclusion'),
-                                            metadata.get(
-                                                mdata, ('properties', k), 'selected'),
-                                            self.select_fields_by_default)]
+        # Applies the rules of singer.should_sync_field with a single
+        # metadata lookup per property
+        selected_properties = []
+        for k in properties:
+            field_mdata = mdata.get(('properties', k), {})
+            inclusion = field_mdata.get('inclusion')
+
+            if inclusion == 'automatic':
+                selected_properties.append(k)
+            elif inclusion != 'unsupported':
+                selected = field_mdata.get('selected')
+                if selected is None:
+                    selected = self.select_fields_by_default
+                if selected:
+                    selected_properties.append(k)
+
+        return selected_properties
 
     def get_start_date(self, state, catalog_entry):
-        catalog_metadata = metadata.to_map(catalog_entry['metadata'])
+        catalog_metadata = self.get_metadata_map(catalog_entry)
         replication_key = catalog_metadata.get((), {}).get('replication-key')
 
         return (singer.get_bookmark(state,
@@ -413,29 +510,20 @@ class Salesforce():
     def _build_query_string(self, catalog_entry, start_date, end_date=None, order_by_clause=True):
         selected_properties = self._get_selected_properties(catalog_entry)
 
-        query = "SELECT {} FROM {}".format(
-            ",".join(selected_properties), catalog_entry['stream'])
+        query_parts = ["SELECT ", ",".join(selected_properties),
+                       " FROM ", catalog_entry['stream']]
 
-        catalog_metadata = metadata.to_map(catalog_entry['metadata'])
+        catalog_metadata = self.get_metadata_map(catalog_entry)
         replication_key = catalog_metadata.get((), {}).get('replication-key')
 
         if replication_key:
-            where_clause = " WHERE {} >= {} ".format(
-                replication_key,
-                start_date)
+            query_parts.extend((" WHERE ", replication_key, " >= ", start_date, " "))
             if end_date:
-                end_date_clause = " AND {} < {}".format(
-                    replication_key, end_date)
-            else:
-                end_date_clause = ""
-
-            order_by = " ORDER BY {} ASC".format(replication_key)
+                query_parts.extend((" AND ", replication_key, " < ", end_date))
             if order_by_clause:
-                return query + where_clause + end_date_clause + order_by
+                query_parts.extend((" ORDER BY ", replication_key, " ASC"))
 
-            return query + where_clause + end_date_clause
-        else:
-            return query
+        return "".join(query_parts)
 
     def query(self, catalog_entry, state):
         if self.api_type == BULK_API_TYPE:
@@ -455,10 +543,9 @@ class Salesforce():
 
     def get_blacklisted_objects(self):
         if self.api_type == BULK_API_TYPE:
-            return UNSUPPORTED_BULK_API_SALESFORCE_OBJECTS.union(
-                QUERY_RESTRICTED_SALESFORCE_OBJECTS).union(QUERY_INCOMPATIBLE_SALESFORCE_OBJECTS)
+            return BULK_API_BLACKLISTED_OBJECTS
         elif self.api_type == REST_API_TYPE:
-            return QUERY_RESTRICTED_SALESFORCE_OBJECTS.union(QUERY_INCOMPATIBLE_SALESFORCE_OBJECTS)
+            return REST_API_BLACKLISTED_OBJECTS
         else:
             raise TapSalesforceException(
                 "api_type should be REST or BULK was: {}".format(
@@ -52,7 +52,7 @@ class Bulk():
             self.check_bulk_quota_usage()
         except requests.exceptions.HTTPError as err:
             if err.response is not None:
-                for error_response_item in err.response.json():
+                for error_response_item in self.sf._parse_error_json(err.response) or []:
                     if error_response_item.get('errorCode') == 'API_DISABLED_FOR_ORG':
                         return False
         return True
@@ -68,7 +68,7 @@ class Bulk():
     # pylint: disable=line-too-long
     def check_bulk_quota_usage(self):
         endpoint = "limits"
-        url = self.sf.data_url.format(self.sf.instance_url, endpoint)
+        url = self.sf._url(endpoint)
 
         with metrics.http_request_timer(endpoint):
             resp = self.sf._make_request('GET', url, headers=self.sf._get_standard_headers()).json()
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+import singer
+
+LOGGER = singer.get_logger()
+
+DESCRIBE_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'tap-salesforce', 'describe')
+DESCRIBE_TTL_ENV_VAR = 'TAP_SALESFORCE_DESCRIBE_TTL'
+DEFAULT_DESCRIBE_TTL = 3600
+DESCRIBE_MAX_STALE_ENV_VAR = 'TAP_SALESFORCE_DESCRIBE_MAX_STALE'
+DEFAULT_DESCRIBE_MAX_STALE = 86400
+
+
+def _get_seconds(env_var, default):
+    seconds = os.environ.get(env_var)
+    if seconds is None or seconds.strip() == '':
+        return default
+
+    try:
+        return float(seconds)
+    except ValueError:
+        LOGGER.warning("Ignoring invalid %s value %s, using %s seconds",
+                       env_var, seconds, default)
+        return default
+
+
+def get_describe_ttl():
+    return _get_seconds(DESCRIBE_TTL_ENV_VAR, DEFAULT_DESCRIBE_TTL)
+
+
+def get_describe_max_stale():
+    return _get_seconds(DESCRIBE_MAX_STALE_ENV_VAR, DEFAULT_DESCRIBE_MAX_STALE)
+
+
+def _get_cache_path(sf):
+    # data_url carries the API version, so an API upgrade invalidates the
+    # cache. The user is part of the key because field visibility depends on
+    # their permissions.
+    identity = [sf.user_id] if sf.user_id else [sf.sf_client_id, sf.refresh_token]
+    cache_key = '|'.join([sf.instance_url, *identity, sf.object_name, sf.data_url])
+    file_name = hashlib.sha256(cache_key.encode('utf-8')).hexdigest() + '.json'
+
+    return os.path.join(DESCRIBE_CACHE_DIR, file_name)
+
+
+def _write_cache(path, description):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as cache_file:
+                json.dump(description, cache_file)
+            # Replace atomically so readers never see a partial file
+            os.replace(tmp_path, path)
+        finally:
+            # Only still there if the write or the replace failed
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    except OSError as e:
+        LOGGER.warning("Unable to write describe cache %s: %s", path, e)
+
+
+def _fetch(sf, path):
+    description = sf.describe()
+    _write_cache(path, description)
+    return description
+
+
+def cached_describe(sf):
+    """Describes sf.object_name, serving the result from a disk cache.
+
+    Cached results older than the TTL are described again. If that describe
+    fails, the cached result is returned instead, as long as it is no older
+    than the max stale limit. A TTL of 0 or less disables the cache."""
+    ttl = get_describe_ttl()
+    if ttl <= 0:
+        return sf.describe()
+
+    path = _get_cache_path(sf)
+
+    try:
+        age = time.time() - os.path.getmtime(path)
+        with open(path, encoding='utf-8') as cache_file:
+            description = json.load(cache_file)
+    except (OSError, ValueError):
+        return _fetch(sf, path)
+
+    if age <= ttl:
+        LOGGER.info("Using cached describe for %s", sf.object_name)
+        return description
+
+    LOGGER.info("Describe cache for %s is stale, refreshing it", sf.object_name)
+    try:
+        return _fetch(sf, path)
+    except Exception as e: # pylint: disable=broad-except
+        if age > get_describe_max_stale():
+            raise
+        LOGGER.warning("Unable to refresh describe cache for %s, using the cached describe: %s",
+                       sf.object_name, e)
+        return description
@@ -47,7 +47,7 @@ class ReportRest():
             return self.__transform_report_api_result(report_results, report_metadata['reportMetadata']['detailColumns'])
 
         except HTTPError as ex:
-            response = ex.response.json()
+            response = self.sf._parse_error_json(ex.response)
             if isinstance(response, list) and response[0].get("errorCode") == "QUERY_TIMEOUT":
                 LOGGER.info(
                     "Salesforce returned QUERY_TIMEOUT querying %s",
@@ -55,8 +55,8 @@ class ReportRest():
             raise ex
 
     def __transform_report_api_result(self, report_results, detail_columns):
-        # Transform and cleanup results
-        results = []
+        # Transform and cleanup results, yielding rows as they are built so
+        # the whole report isn't held twice in memory
         for row in report_results:
             data_cell = row['dataCells']
             tmp_row = {}
@@ -69,6 +69,4 @@ class ReportRest():
                 else:
                     tmp_row[detail_columns[i]] = ''
 
-            results.append(tmp_row)
-
-        return results
+            yield tmp_row
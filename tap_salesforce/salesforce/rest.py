@@ -28,7 +28,7 @@ class Rest():
             end_date=None,
             retries=MAX_RETRIES):
         params = {"q": query}
-        url = "{}/services/data/v41.0/queryAll".format(self.sf.instance_url)
+        url = self.sf._url('queryAll')
         headers = self.sf._get_standard_headers()
 
         sync_start = singer_utils.now()
@@ -58,7 +58,7 @@ class Rest():
                     yield record
 
         except HTTPError as ex:
-            response = ex.response.json()
+            response = self.sf._parse_error_json(ex.response)
             if isinstance(response, list) and response[0].get("errorCode") == "QUERY_TIMEOUT":
                 start_date = singer_utils.strptime_with_tz(start_date_str)
                 day_range = (end_date - start_date).days
@@ -90,16 +90,21 @@ class Rest():
                 yield record
 
     def _sync_records(self, url, headers, params):
-        while True:
-            resp = self.sf._make_request('GET', url, headers=headers, params=params)
-            resp_json = resp.json()
-
-            for rec in resp_json.get('records'):
-                yield rec
-
-            next_records_url = resp_json.get('nextRecordsUrl')
-
-            if next_records_url is None:
-                break
-
-            url = "{}{}".format(self.sf.instance_url, next_records_url)
+        while url is not None:
+            # Each page only lives in _sync_page, so it is released before
+            # the next one is requested
+            url = yield from self._sync_page(url, headers, params)
+
+    def _sync_page(self, url, headers, params):
+        """Yields the records of one query page and returns the URL of the
+        next page, or None for the last one."""
+        resp = self.sf._make_request('GET', url, headers=headers, params=params)
+        resp_json = resp.json()
+
+        for rec in resp_json.get('records'):
+            yield rec
+
+        next_records_url = resp_json.get('nextRecordsUrl')
+        if next_records_url is None:
+            return None
+        return self.sf.instance_url + next_records_url
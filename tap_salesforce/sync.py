@@ -1,44 +1,166 @@
+import contextlib
+import functools
+import queue
+import re
+import sys
+import threading
 import time
 import singer
 import singer.utils as singer_utils
 from singer import Transformer, metadata, metrics
+from singer.messages import format_message
 from requests.exceptions import RequestException
+from tap_salesforce.salesforce import REST_API_TYPE
 from tap_salesforce.salesforce.bulk import Bulk
 
 LOGGER = singer.get_logger()
 
-BLACKLISTED_FIELDS = set(['attributes'])
+BLACKLISTED_FIELDS = frozenset(['attributes'])
+
+# The stripped strings int() and float() accept. Checking these first means
+# text and date values are left alone without raising from every cast.
+INTEGER_PATTERN = re.compile(r'[+-]?\d+')
+FLOAT_PATTERN = re.compile(r'[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?|[+-]?(inf(inity)?|nan)',
+                           re.IGNORECASE)
+
+# While syncing records, state is written after this many bookmark updates
+# or seconds, whichever comes first
+STATE_WRITE_UPDATES = 1000
+STATE_WRITE_SECONDS = 5
+
+# Number of records fetched ahead of the writer by iter_in_background, about
+# one page of REST query results
+PREFETCH_QUEUE_SIZE = 2000
 
 
 def remove_blacklisted_fields(data):
-    return {k: v for k, v in data.items() if k not in BLACKLISTED_FIELDS}
+    # Records are owned by the sync loop, so drop the fields in place rather
+    # than copying every column into a new dict
+    for field in BLACKLISTED_FIELDS:
+        if field in data:
+            del data[field]
+    return data
 
 # pylint: disable=unused-argument
 
 
 def transform_bulk_data_hook(data, typ, schema):
-    result = data
-    if isinstance(data, dict):
-        result = remove_blacklisted_fields(data)
+    # Only dicts and the two special string values below are rewritten, so
+    # everything else is returned without touching the schema
+    if not isinstance(data, str):
+        if isinstance(data, dict):
+            return remove_blacklisted_fields(data)
+        return data
+
+    # Salesforce Bulk API returns CSV's with empty strings for text fields.
+    # When the text field is nillable and the data value is an empty string,
+    # change the data so that it is None.
+    if data == "":
+        if "null" in schema['type']:
+            return None
+        return data
 
     # Salesforce can return the value '0.0' for integer typed fields. This
     # causes a schema violation. Convert it to '0' if schema['type'] has
     # integer.
     if data == '0.0' and 'integer' in schema.get('type', []):
-        result = '0'
+        return '0'
+
+    return data
 
-    # Salesforce Bulk API returns CSV's with empty strings for text fields.
-    # When the text field is nillable and the data value is an empty string,
-    # change the data so that it is None.
-    if data == "" and "null" in schema['type']:
-        result = None
 
-    return result
+def write_record_message(message):
+    """Writes a message like singer.write_message, without flushing stdout.
+    Records are flushed in blocks by the stdout buffer, and in order with
+    the state messages, which singer.write_state still flushes."""
+    sys.stdout.write(format_message(message) + '\n')
 
 
-def get_stream_version(catalog_entry, state):
+def iter_in_background(iterable, maxsize=PREFETCH_QUEUE_SIZE):
+    """Iterates iterable on a background thread, handing its items over
+    through a bounded queue so fetching the next ones overlaps with
+    processing the current ones. Exceptions from the iterable are raised
+    to the caller."""
+    items = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        # BaseException too, or the consumer would wait forever for the
+        # end of the items
+        except BaseException as ex: # pylint: disable=broad-except
+            put((done, ex))
+        else:
+            put((done, None))
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        # Lets the producer exit if the caller stops iterating early
+        stop.set()
+
+
+def make_record_message(record_stream, stream_version, start_time):
+    """Returns a RecordMessage constructor that only takes the record, the
+    one thing that changes from one message of a stream to the next."""
+    return functools.partial(singer.RecordMessage,
+                             stream=record_stream,
+                             version=stream_version,
+                             time_extracted=start_time)
+
+
+class StateWriter():
+    """Writes state after STATE_WRITE_UPDATES bookmark updates or
+    STATE_WRITE_SECONDS, whichever comes first, as writing the whole state
+    for every record is costly. flush writes whatever is left once the
+    records stop, including when the sync fails part way."""
+
+    def __init__(self):
+        self.updates = 0
+        self.last_write = time.monotonic()
+
+    def bookmark_updated(self, state):
+        self.updates += 1
+        if self.updates >= STATE_WRITE_UPDATES or \
+           time.monotonic() - self.last_write >= STATE_WRITE_SECONDS:
+            self.write(state)
+
+    def flush(self, state):
+        """Writes state if any bookmark updates haven't been written yet."""
+        if self.updates:
+            self.write(state)
+
+    def write(self, state):
+        singer.write_state(state)
+        self.updates = 0
+        self.last_write = time.monotonic()
+
+
+def get_stream_version(catalog_entry, state, catalog_metadata=None):
     tap_stream_id = catalog_entry['tap_stream_id']
-    catalog_metadata = metadata.to_map(catalog_entry['metadata'])
+    if catalog_metadata is None:
+        catalog_metadata = metadata.to_map(catalog_entry['metadata'])
     replication_key = catalog_metadata.get((), {}).get('replication-key')
 
     if singer.get_bookmark(state, tap_stream_id, 'version') is None:
@@ -53,56 +175,73 @@ def get_stream_version(catalog_entry, state):
 
 def resume_syncing_bulk_query(sf, catalog_entry, job_id, state, counter):
     bulk = Bulk(sf)
+    tap_stream_id = catalog_entry['tap_stream_id']
     current_bookmark = singer.get_bookmark(
-        state, catalog_entry['tap_stream_id'], 'JobHighestBookmarkSeen') or sf.get_start_date(state, catalog_entry)
+        state, tap_stream_id, 'JobHighestBookmarkSeen') or sf.get_start_date(state, catalog_entry)
     current_bookmark = singer_utils.strptime_with_tz(current_bookmark)
     batch_ids = singer.get_bookmark(
-        state, catalog_entry['tap_stream_id'], 'BatchIDs')
+        state, tap_stream_id, 'BatchIDs')
 
     start_time = singer_utils.now()
     stream = catalog_entry['stream']
     stream_alias = catalog_entry.get('stream_alias')
-    catalog_metadata = metadata.to_map(catalog_entry.get('metadata'))
+    record_stream = stream_alias or stream
+    catalog_metadata = sf.get_metadata_map(catalog_entry)
     replication_key = catalog_metadata.get((), {}).get('replication-key')
-    stream_version = get_stream_version(catalog_entry, state)
+    stream_version = get_stream_version(catalog_entry, state, catalog_metadata)
     schema = catalog_entry['schema']
+    anytype_properties = get_anytype_properties(schema)
 
     if not bulk.job_exists(job_id):
         LOGGER.info(
             "Found stored Job ID that no longer exists, resetting bookmark and removing JobID from state.")
         return counter
 
-    # Iterate over the remaining batches, removing them once they are synced
-    for batch_id in batch_ids[:]:
-        with Transformer(pre_hook=transform_bulk_data_hook) as transformer:
+    record_message = make_record_message(record_stream, stream_version, start_time)
+    write_message = write_record_message
+    strptime_with_tz = singer_utils.strptime_with_tz
+    strftime = singer_utils.strftime
+    write_bookmark = singer.write_bookmark
+
+    # Batch results are downloaded on a background thread while the records
+    # already fetched are written. A None record marks the end of a batch, so
+    # state is still only written here, after all of a batch's records.
+    def batch_records():
+        for batch_id in batch_ids[:]:
             for rec in bulk.get_batch_results(job_id, batch_id, catalog_entry):
-                counter.increment()
-                rec = transformer.transform(rec, schema)
-                rec = fix_record_anytype(rec, schema)
-                singer.write_message(
-                    singer.RecordMessage(
-                        stream=(
-                            stream_alias or stream),
-                        record=rec,
-                        version=stream_version,
-                        time_extracted=start_time))
-
-                # Update bookmark if necessary
-                replication_key_value = replication_key and singer_utils.strptime_with_tz(
-                    rec[replication_key])
-                if replication_key_value and replication_key_value <= start_time and replication_key_value > current_bookmark:
-                    current_bookmark = singer_utils.strptime_with_tz(
-                        rec[replication_key])
-
-        state = singer.write_bookmark(state,
-                                      catalog_entry['tap_stream_id'],
-                                      'JobHighestBookmarkSeen',
-                                      singer_utils.strftime(current_bookmark))
-        batch_ids.remove(batch_id)
-        LOGGER.info(
-            "Finished syncing batch %s. Removing batch from state.", batch_id)
-        LOGGER.info("Batches to go: %d", len(batch_ids))
-        singer.write_state(state)
+                yield batch_id, rec
+            yield batch_id, None
+
+    # Iterate over the remaining batches, removing them once they are synced
+    # Closed explicitly so the producer stops even if this loop raises, when
+    # the traceback would otherwise keep the generator alive
+    with Transformer(pre_hook=transform_bulk_data_hook) as transformer, \
+         contextlib.closing(iter_in_background(batch_records())) as records:
+        transform = transformer.transform
+        for batch_id, rec in records:
+            if rec is None:
+                state = write_bookmark(state,
+                                       tap_stream_id,
+                                       'JobHighestBookmarkSeen',
+                                       strftime(current_bookmark))
+                batch_ids.remove(batch_id)
+                LOGGER.info(
+                    "Finished syncing batch %s. Removing batch from state.", batch_id)
+                LOGGER.info("Batches to go: %d", len(batch_ids))
+                singer.write_state(state)
+                continue
+
+            counter.increment()
+            rec = transform(rec, schema)
+            if anytype_properties:
+                rec = fix_record_anytype(rec, schema, anytype_properties)
+            write_message(record_message(record=rec))
+
+            # Update bookmark if necessary
+            replication_key_value = replication_key and strptime_with_tz(
+                rec[replication_key])
+            if replication_key_value and replication_key_value <= start_time and replication_key_value > current_bookmark:
+                current_bookmark = replication_key_value
 
     return counter
 
@@ -128,79 +267,104 @@ def sync_stream(sf, catalog_entry, state):
 
 
 def sync_records(sf, catalog_entry, state, counter):
+    tap_stream_id = catalog_entry['tap_stream_id']
     chunked_bookmark = singer_utils.strptime_with_tz(
         sf.get_start_date(state, catalog_entry))
     stream = catalog_entry['stream']
     schema = catalog_entry['schema']
+    anytype_properties = get_anytype_properties(schema)
     stream_alias = catalog_entry.get('stream_alias')
-    catalog_metadata = metadata.to_map(catalog_entry['metadata'])
+    catalog_metadata = sf.get_metadata_map(catalog_entry)
     replication_key = catalog_metadata.get((), {}).get('replication-key')
-    stream_version = get_stream_version(catalog_entry, state)
-    activate_version_message = singer.ActivateVersionMessage(stream=(stream_alias or stream),
+    stream_version = get_stream_version(catalog_entry, state, catalog_metadata)
+    record_stream = stream_alias or stream
+    activate_version_message = singer.ActivateVersionMessage(stream=record_stream,
                                                              version=stream_version)
 
     start_time = singer_utils.now()
+    state_writer = StateWriter()
 
     LOGGER.info('Syncing Salesforce data for stream %s', stream)
 
-    for rec in sf.query(catalog_entry, state):
-        counter.increment()
-        with Transformer(pre_hook=transform_bulk_data_hook) as transformer:
-            rec = transformer.transform(rec, schema)
-        rec = fix_record_anytype(rec, schema)
-        singer.write_message(
-            singer.RecordMessage(
-                stream=(
-                    stream_alias or stream),
-                record=rec,
-                version=stream_version,
-                time_extracted=start_time))
-
-        replication_key_value = replication_key and singer_utils.strptime_with_tz(
-            rec[replication_key])
-
-        if sf.pk_chunking:
-            if replication_key_value and replication_key_value <= start_time and replication_key_value > chunked_bookmark:
-                # Replace the highest seen bookmark and save the state in case we need to resume later
-                chunked_bookmark = singer_utils.strptime_with_tz(
-                    rec[replication_key])
-                state = singer.write_bookmark(
-                    state,
-                    catalog_entry['tap_stream_id'],
-                    'JobHighestBookmarkSeen',
-                    singer_utils.strftime(chunked_bookmark))
-                singer.write_state(state)
-        # Before writing a bookmark, make sure Salesforce has not given us a
-        # record with one outside our range
-        elif replication_key_value and replication_key_value <= start_time:
-            state = singer.write_bookmark(
-                state,
-                catalog_entry['tap_stream_id'],
-                replication_key,
-                rec[replication_key])
-            singer.write_state(state)
+    record_message = make_record_message(record_stream, stream_version, start_time)
+    write_message = write_record_message
+    strptime_with_tz = singer_utils.strptime_with_tz
+    strftime = singer_utils.strftime
+    write_bookmark = singer.write_bookmark
+
+    records = sf.query(catalog_entry, state)
+    # REST queries only page through results, so the next page can be
+    # fetched while this one is written. Bulk queries write state from
+    # inside the generator and have to stay on this thread.
+    if sf.api_type == REST_API_TYPE:
+        records = iter_in_background(records)
+
+    with Transformer(pre_hook=transform_bulk_data_hook) as transformer:
+        transform = transformer.transform
+        try:
+            for rec in records:
+                counter.increment()
+                rec = transform(rec, schema)
+                if anytype_properties:
+                    rec = fix_record_anytype(rec, schema, anytype_properties)
+                write_message(record_message(record=rec))
+
+                replication_key_str = replication_key and rec[replication_key]
+                replication_key_value = replication_key and strptime_with_tz(
+                    replication_key_str)
+
+                bookmark_updated = False
+                if sf.pk_chunking:
+                    if replication_key_value and replication_key_value <= start_time and replication_key_value > chunked_bookmark:
+                        # Replace the highest seen bookmark and save the state in case we need to resume later
+                        chunked_bookmark = replication_key_value
+                        state = write_bookmark(
+                            state,
+                            tap_stream_id,
+                            'JobHighestBookmarkSeen',
+                            strftime(chunked_bookmark))
+                        bookmark_updated = True
+                # Before writing a bookmark, make sure Salesforce has not given us a
+                # record with one outside our range
+                elif replication_key_value and replication_key_value <= start_time:
+                    state = write_bookmark(
+                        state,
+                        tap_stream_id,
+                        replication_key,
+                        replication_key_str)
+                    bookmark_updated = True
+
+                if bookmark_updated:
+                    state_writer.bookmark_updated(state)
+        finally:
+            # Stops a background producer even if the loop raised, when the
+            # traceback would otherwise keep the generator alive
+            records.close()
+            # Keeps the progress made so far, even when the sync fails
+            state_writer.flush(state)
 
         # Tables with no replication_key will send an
         # activate_version message for the next sync
     if not replication_key:
         singer.write_message(activate_version_message)
-        state = singer.write_bookmark(
-            state, catalog_entry['tap_stream_id'], 'version', None)
+        state = write_bookmark(
+            state, tap_stream_id, 'version', None)
 
     # If pk_chunking is set, only write a bookmark at the end
     if sf.pk_chunking:
         # Write a bookmark with the highest value we've seen
-        state = singer.write_bookmark(
+        state = write_bookmark(
             state,
-            catalog_entry['tap_stream_id'],
+            tap_stream_id,
             replication_key,
-            singer_utils.strftime(chunked_bookmark))
+            strftime(chunked_bookmark))
 
 
 def sync_report(sf, catalog_entry, state, counter):
+    tap_stream_id = catalog_entry['tap_stream_id']
 
     # Make sure that the report id in the config & stream are the same
-    if catalog_entry['tap_stream_id'] != sf.report_id:
+    if tap_stream_id != sf.report_id:
         LOGGER.error(
             'report_id in the stream should match the report_id in the config')
         raise Exception(
@@ -210,92 +374,119 @@ def sync_report(sf, catalog_entry, state, counter):
         sf.get_start_date(state, catalog_entry))
     stream = catalog_entry['stream']
     schema = catalog_entry['schema']
+    anytype_properties = get_anytype_properties(schema)
     stream_alias = catalog_entry.get('stream_alias')
-    catalog_metadata = metadata.to_map(catalog_entry['metadata'])
+    catalog_metadata = sf.get_metadata_map(catalog_entry)
     replication_key = catalog_metadata.get((), {}).get('replication-key')
-    stream_version = get_stream_version(catalog_entry, state)
-    activate_version_message = singer.ActivateVersionMessage(stream=(stream_alias or stream),
+    stream_version = get_stream_version(catalog_entry, state, catalog_metadata)
+    record_stream = stream_alias or stream
+    activate_version_message = singer.ActivateVersionMessage(stream=record_stream,
                                                              version=stream_version)
 
     start_time = singer_utils.now()
+    state_writer = StateWriter()
 
     LOGGER.info('Syncing Salesforce report data for stream %s', stream)
 
-    for rec in sf.query_report(catalog_entry, state):
-        counter.increment()
-        with Transformer() as transformer:
-            rec = transformer.transform(rec, schema)
-        rec = fix_record_anytype(rec, schema)
-
-        singer.write_message(
-            singer.RecordMessage(
-                stream=(
-                    stream_alias or stream),
-                record=rec,
-                version=stream_version,
-                time_extracted=start_time))
-
-        replication_key_value = replication_key and singer_utils.strptime_with_tz(
-            rec[replication_key])
-
-        if sf.pk_chunking:
-            if replication_key_value and replication_key_value <= start_time and replication_key_value > chunked_bookmark:
-                # Replace the highest seen bookmark and save the state in case we need to resume later
-                chunked_bookmark = singer_utils.strptime_with_tz(
-                    rec[replication_key])
-                state = singer.write_bookmark(
-                    state,
-                    catalog_entry['tap_stream_id'],
-                    'JobHighestBookmarkSeen',
-                    singer_utils.strftime(chunked_bookmark))
-                singer.write_state(state)
-        # Before writing a bookmark, make sure Salesforce has not given us a
-        # record with one outside our range
-        elif replication_key_value and replication_key_value <= start_time:
-            state = singer.write_bookmark(
-                state,
-                catalog_entry['tap_stream_id'],
-                replication_key,
-                rec[replication_key])
-            singer.write_state(state)
+    record_message = make_record_message(record_stream, stream_version, start_time)
+    write_message = write_record_message
+    strptime_with_tz = singer_utils.strptime_with_tz
+    strftime = singer_utils.strftime
+    write_bookmark = singer.write_bookmark
+
+    with Transformer() as transformer:
+        transform = transformer.transform
+        try:
+            for rec in sf.query_report(catalog_entry, state):
+                counter.increment()
+                rec = transform(rec, schema)
+                if anytype_properties:
+                    rec = fix_record_anytype(rec, schema, anytype_properties)
+
+                write_message(record_message(record=rec))
+
+                replication_key_str = replication_key and rec[replication_key]
+                replication_key_value = replication_key and strptime_with_tz(
+                    replication_key_str)
+
+                bookmark_updated = False
+                if sf.pk_chunking:
+                    if replication_key_value and replication_key_value <= start_time and replication_key_value > chunked_bookmark:
+                        # Replace the highest seen bookmark and save the state in case we need to resume later
+                        chunked_bookmark = replication_key_value
+                        state = write_bookmark(
+                            state,
+                            tap_stream_id,
+                            'JobHighestBookmarkSeen',
+                            strftime(chunked_bookmark))
+                        bookmark_updated = True
+                # Before writing a bookmark, make sure Salesforce has not given us a
+                # record with one outside our range
+                elif replication_key_value and replication_key_value <= start_time:
+                    state = write_bookmark(
+                        state,
+                        tap_stream_id,
+                        replication_key,
+                        replication_key_str)
+                    bookmark_updated = True
+
+                if bookmark_updated:
+                    state_writer.bookmark_updated(state)
+        finally:
+            # Keeps the progress made so far, even when the sync fails
+            state_writer.flush(state)
 
         # Tables with no replication_key will send an
         # activate_version message for the next sync
     if not replication_key:
         singer.write_message(activate_version_message)
-        state = singer.write_bookmark(
-            state, catalog_entry['tap_stream_id'], 'version', None)
+        state = write_bookmark(
+            state, tap_stream_id, 'version', None)
 
     # If pk_chunking is set, only write a bookmark at the end
     if sf.pk_chunking:
         # Write a bookmark with the highest value we've seen
-        state = singer.write_bookmark(
+        state = write_bookmark(
             state,
-            catalog_entry['tap_stream_id'],
+            tap_stream_id,
             replication_key,
-            singer_utils.strftime(chunked_bookmark))
+            strftime(chunked_bookmark))
+
 
+def get_anytype_properties(schema):
+    """Returns the properties that fix_record_anytype has to coerce, those
+    with the empty schema field_to_property_schema gives anyType and
+    calculated fields.
+    Dates have no 'type' element either, but their anyOf schema already
+    keeps them strings."""
+    return [k for k, v in schema['properties'].items() if not v]
 
-def fix_record_anytype(rec, schema):
+
+def fix_record_anytype(rec, schema, anytype_properties=None):
     """Modifies a record when the schema has no 'type' element due to a SF type of 'anyType.'
-    Attempts to set the record's value for that element to an int, float, or string."""
-    def try_cast(val, coercion):
-        try:
-            return coercion(val)
-        except BaseException:
-            return val
-
-    for k, v in rec.items():
-        if schema['properties'][k].get("type") is None:
-            val = v
-            val = try_cast(v, int)
-            val = try_cast(v, float)
-            if v in ["true", "false"]:
-                val = (v == "true")
-
-            if v == "":
-                val = None
-
-            rec[k] = val
+    Attempts to set the record's value for that element to an int, float, or string.
+
+    anytype_properties can be passed in from get_anytype_properties to avoid
+    recomputing it for every record of a stream."""
+    if anytype_properties is None:
+        anytype_properties = get_anytype_properties(schema)
+
+    for k in anytype_properties:
+        v = rec.get(k)
+        # Only strings need coercing; typed JSON values are already right
+        if not isinstance(v, str):
+            continue
+
+        if v in ["true", "false"]:
+            rec[k] = (v == "true")
+        elif v == "":
+            rec[k] = None
+        else:
+            stripped = v.strip()
+            # Integer strings stay ints instead of always becoming floats
+            if INTEGER_PATTERN.fullmatch(stripped):
+                rec[k] = int(v)
+            elif FLOAT_PATTERN.fullmatch(stripped):
+                rec[k] = float(v)
 
     return rec
@@ -0,0 +1,92 @@
+import threading
+import unittest
+from unittest import mock
+
+from tap_salesforce.sync import (
+    StateWriter, fix_record_anytype, get_anytype_properties, iter_in_background)
+
+DATE_TIME_SCHEMA = {
+    "anyOf": [{"type": "string", "format": "date-time"},
+              {"type": ["string", "null"]}]
+}
+
+
+class TestGetAnytypeProperties(unittest.TestCase):
+
+    def test_only_empty_schemas_are_anytype(self):
+        schema = {"properties": {"Any": {},
+                                 "CreatedDate": DATE_TIME_SCHEMA,
+                                 "Name": {"type": ["null", "string"]}}}
+
+        self.assertEqual(get_anytype_properties(schema), ["Any"])
+
+
+class TestFixRecordAnytype(unittest.TestCase):
+
+    def test_date_time_field_is_left_alone(self):
+        schema = {"properties": {"Any": {}, "CreatedDate": DATE_TIME_SCHEMA}}
+        rec = {"Any": "5", "CreatedDate": "2021-01-01T00:00:00.000000Z"}
+
+        fix_record_anytype(rec, schema)
+
+        self.assertEqual(rec, {"Any": 5, "CreatedDate": "2021-01-01T00:00:00.000000Z"})
+
+    def test_only_numbers_are_converted(self):
+        schema = {"properties": {"Date": {}, "DateTime": {}, "Text": {}, "Int": {}, "Float": {}}}
+        rec = {"Date": "2021-01-01", "DateTime": "2021-01-01T00:00:00.000Z",
+               "Text": "abc", "Int": "-7", "Float": "1.5e-3"}
+
+        with mock.patch('tap_salesforce.sync.int', create=True, wraps=int) as int_mock, \
+             mock.patch('tap_salesforce.sync.float', create=True, wraps=float) as float_mock:
+            fix_record_anytype(rec, schema)
+
+        int_mock.assert_called_once_with("-7")
+        float_mock.assert_called_once_with("1.5e-3")
+        self.assertEqual(rec, {"Date": "2021-01-01", "DateTime": "2021-01-01T00:00:00.000Z",
+                               "Text": "abc", "Int": -7, "Float": 0.0015})
+
+    def test_empty_string_becomes_none(self):
+        rec = fix_record_anytype({"Any": ""}, {"properties": {"Any": {}}})
+
+        self.assertEqual(rec, {"Any": None})
+
+
+class TestStateWriter(unittest.TestCase):
+
+    @mock.patch('tap_salesforce.sync.singer.write_state')
+    def test_flush_writes_only_pending_updates(self, write_state):
+        state_writer = StateWriter()
+
+        state_writer.flush({})
+        write_state.assert_not_called()
+
+        state_writer.bookmark_updated({"bookmarks": {}})
+        state_writer.flush({"bookmarks": {}})
+        write_state.assert_called_once_with({"bookmarks": {}})
+
+
+class TestIterInBackground(unittest.TestCase):
+
+    def test_producer_stops_once_closed(self):
+        stopped = threading.Event()
+
+        def endless():
+            try:
+                while True:
+                    yield 1
+            finally:
+                stopped.set()
+
+        items = iter_in_background(endless(), maxsize=1)
+        next(items)
+        items.close()
+
+        self.assertTrue(stopped.wait(5))
+
+    def test_producer_errors_are_raised(self):
+        def interrupted():
+            yield 1
+            raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            list(iter_in_background(interrupted()))